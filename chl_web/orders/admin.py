@@ -1,9 +1,9 @@
 """Orders admin setup."""
 from django.contrib import admin
 
-from .models import Order, OrderItem
+from .models import Order, OrderItem, OrderRaw
 
 
 admin.site.register(Order)
 admin.site.register(OrderItem)
-
+admin.site.register(OrderRaw)
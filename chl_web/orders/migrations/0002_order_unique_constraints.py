@@ -0,0 +1,22 @@
+# Generated by Django 3.0.10 on 2026-10-15 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='order_number',
+            field=models.CharField(max_length=30, unique=True, verbose_name='No. pedido'),
+        ),
+        migrations.AddConstraint(
+            model_name='orderitem',
+            constraint=models.UniqueConstraint(fields=('order', 'ean'), name='uniq_order_ean'),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 3.0.10 on 2026-10-15 12:30
+
+from itertools import islice
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import model_utils.fields
+
+
+def copy_from_api_to_order_raw(apps, schema_editor):
+    Order = apps.get_model('orders', 'Order')
+    OrderRaw = apps.get_model('orders', 'OrderRaw')
+    order_raws = (
+        OrderRaw(order_id=order_id, data=from_api)
+        for order_id, from_api in Order.objects.values_list('id', 'from_api').iterator()
+    )
+    # bulk_create() turns any iterable into a list, so feed it bounded chunks.
+    while True:
+        batch = list(islice(order_raws, 500))
+        if not batch:
+            break
+        OrderRaw.objects.bulk_create(batch)
+
+
+def copy_order_raw_to_from_api(apps, schema_editor):
+    Order = apps.get_model('orders', 'Order')
+    OrderRaw = apps.get_model('orders', 'OrderRaw')
+    for order_id, data in OrderRaw.objects.values_list('order_id', 'data').iterator():
+        Order.objects.filter(id=order_id).update(from_api=data)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0002_order_unique_constraints'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='from_api',
+            field=django.contrib.postgres.fields.jsonb.JSONField(null=True),
+        ),
+        migrations.CreateModel(
+            name='OrderRaw',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('data', django.contrib.postgres.fields.jsonb.JSONField()),
+                ('order', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='raw', to='orders.Order')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.RunPython(copy_from_api_to_order_raw, copy_order_raw_to_from_api),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.0.10 on 2026-10-15 12:30
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0003_orderraw'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='order',
+            name='from_api',
+        ),
+    ]
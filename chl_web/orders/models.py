@@ -1,14 +1,77 @@
 """Order models."""
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from datetime import datetime, timedelta
-from typing import List
+from queue import Queue
+from typing import Iterator, List
+from urllib.parse import urlencode
 
+import ciso8601
+import orjson
 import paramiko
 import requests
 from django.conf import settings
 from django.contrib.postgres.fields import JSONField
-from django.db import models
+from django.core.cache import cache
+from django.db import models, transaction
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from model_utils.models import TimeStampedModel
+from requests.adapters import HTTPAdapter
+
+VTEX_API_MAX_WORKERS = 32
+VTEX_API_TIMEOUT = 10
+VTEX_API_CACHE_TIMEOUT = 60 * 60
+BULK_BATCH_SIZE = 500
+SFTP_MAX_CHANNELS = 8
+
+ADDRESS_INFO_FIELDS = ("street", "number", "complement", "neighborhood")
+
+FILE_HEADERS_TEMPLATE = (
+    "{order.order_type}"  # Tipo
+    "|{order.client_code}"  # Código del tercero
+    "|{order.file_type}"  # Tipo de archivo
+    "|{order.company_code}"  # Compañia
+    "|{order_created_at}"  # Fecha de la orden
+    "|{shipping_stimate_date}"  # Fecha planificada de entrega
+    "|{order.currency}"  # Moneda
+    "|{order.buyer_fullname}/{order.buyer_document}/{order.shipping_address_city}"
+    "/{order.shipping_address}/{order.buyer_phone}/{order.shipping_address_reference}"  # Texto
+    "|1"  # 1
+    "|{order.warehouse_code}"  # CodDirección de la cabecera
+    "|{order.order_number}"  # No. pedido
+    "|?,{order.buyer_document},?,{order.buyer_fullname},{order.sell_type},{order.shipping_address_zip}"
+    # Datos localización Colombia
+    "|{order.sell_type_code},{order.payment_proof}"  # Tipo de venta + Ref A
+    "|{order.seller_code}"  # Vendedor
+    "|{order.route_text_code}"  # CodTextoRuta
+    "|{order.buyer_email}"  # Correo electrónico
+)
+
+# Shared session so every vtex call reuses a pooled keep-alive connection.
+# The pool blocks when exhausted instead of opening throwaway connections.
+session = requests.Session()
+session.mount(
+    "https://",
+    HTTPAdapter(pool_connections=1, pool_maxsize=VTEX_API_MAX_WORKERS, pool_block=True),
+)
+
+
+def cached_get(url: str, headers: dict, params: dict = None) -> dict:
+    """Get a vtex api json response, reusing cached responses when available."""
+    query = urlencode(sorted(params.items())) if params else ""
+    cache_key = "vtex:" + hashlib.sha1(f"{url}?{query}".encode()).hexdigest()
+    data = cache.get(cache_key)
+    if data is None:
+        response = session.get(
+            url, headers=headers, params=params, timeout=VTEX_API_TIMEOUT
+        )
+        response.raise_for_status()
+        data = orjson.loads(response.content)
+        cache.set(cache_key, data, VTEX_API_CACHE_TIMEOUT)
+    return data
 
 
 class Order(TimeStampedModel):
@@ -42,7 +105,9 @@ class Order(TimeStampedModel):
     warehouse_code = models.CharField(
         verbose_name=_("codDIrección de la cabecera"), max_length=128
     )
-    order_number = models.CharField(verbose_name=_("No. pedido"), max_length=30)
+    order_number = models.CharField(
+        verbose_name=_("No. pedido"), max_length=30, unique=True
+    )
     sell_type = models.CharField(verbose_name=_("tipo de venta"), max_length=56)
     sell_type_code = models.CharField(
         verbose_name=_("código tipo de venta"), max_length=56
@@ -54,24 +119,23 @@ class Order(TimeStampedModel):
     route_text_code = models.CharField(
         verbose_name=_("codTextoRuta"), max_length=56, blank=True, null=True
     )
-    from_api = JSONField()
 
     @staticmethod
     def erp_strftime(date: datetime = None) -> str:
         """Format date for erp file."""
         if date is None:
             return ""
-        return datetime.strftime(date, "%d%m%Y")
+        return f"{date.day:02d}{date.month:02d}{date.year:04d}"
 
     @staticmethod
     def ws_strptime(date: str) -> datetime:
         """
         Parse and format date received from webservice to datetime.
 
-            - Remove microseconds and Timezone from str date
             - Parse str date to datetime
+            - Remove microseconds and Timezone
         """
-        return datetime.strptime(date.split(".")[0], "%Y-%m-%dT%H:%M:%S")
+        return ciso8601.parse_datetime_as_naive(date).replace(microsecond=0)
 
     @staticmethod
     def get_orders_filter_hours_range(
@@ -79,10 +143,11 @@ class Order(TimeStampedModel):
     ) -> str:
         """Get order filters hours range."""
         hours_range_format = "%Y-%m-%dT%H:%M:%S.%fZ"
+        now = datetime.utcnow()
         if from_time is None:
-            from_time = datetime.utcnow()
+            from_time = now - timedelta(hours=1)
         if to_time is None:
-            to_time = datetime.utcnow() - timedelta(hours=1)
+            to_time = now
         hours_range = {
             "from": datetime.strftime(from_time, hours_range_format),
             "to": datetime.strftime(to_time, hours_range_format),
@@ -94,6 +159,15 @@ class Order(TimeStampedModel):
         return f"{self.order_number} - {self.buyer_fullname} - {self.order_created_at}"
 
 
+class OrderRaw(TimeStampedModel):
+    """Order data as received from the webservice."""
+
+    order = models.OneToOneField(
+        "orders.Order", on_delete=models.CASCADE, related_name="raw"
+    )
+    data = JSONField()
+
+
 class OrderItem(TimeStampedModel):
     """Order item model."""
 
@@ -117,35 +191,74 @@ class OrderItem(TimeStampedModel):
         verbose_name=_("código fiscal"), max_length=3, choices=TaxCode.choices
     )
 
+    class Meta:
+        """Order item unique constraints."""
+
+        constraints = [
+            models.UniqueConstraint(fields=["order", "ean"], name="uniq_order_ean")
+        ]
+
 
 class VtexClientOrderItem(OrderItem):
     """Vtex client order model."""
 
-    def __init__(self, *args, **kwargs):
-        """Set vtex order default values."""
-        kwargs["item_type"] = "D"
-        kwargs["qty"] = 0
-        kwargs["destination_address_code"] = ""
+    DEFAULTS = {
+        "item_type": "D",
+        "qty": 0,
+        "destination_address_code": "",
         # TODO verify if this field is dynamic
-        kwargs["tax_code"] = OrderItem.TaxCode.IVA
-        super().__init__(*args, **kwargs)
+        "tax_code": OrderItem.TaxCode.IVA,
+    }
 
     @staticmethod
     def factory(orders_from_db: list):
         """Orders factory method."""
-        objects = []
-        for order in orders_from_db:
-            for index, item in enumerate(order.from_api["items"]):
-                defaults = {
-                    "item_number": index + 1,
-                    "item_qty": item["quantity"],
-                    "item_price_without_tax": item["price"] // 100,
-                }
-                objects.append(
-                    VtexClientOrderItem.objects.update_or_create(
-                        order=order, ean=item["ean"], defaults=defaults
-                    )[0]
-                )
+        existing_items = {
+            (item.order_id, item.ean): item
+            for item in VtexClientOrderItem.objects.filter(order__in=orders_from_db)
+        }
+        items = {
+            (order.pk, item["ean"]): {
+                **VtexClientOrderItem.DEFAULTS,
+                "order": order,
+                "ean": item["ean"],
+                "item_number": item_number,
+                "item_qty": item["quantity"],
+                "item_price_without_tax": item["price"] // 100,
+            }
+            for order in orders_from_db
+            for item_number, item in enumerate(order.raw.data["items"], start=1)
+        }
+
+        objects, objects_to_create, objects_to_update = [], [], []
+        now = timezone.now()
+        for key, values in items.items():
+            obj = existing_items.get(key)
+            if obj is None:
+                obj = VtexClientOrderItem(**values)
+                objects_to_create.append(obj)
+            else:
+                for field, value in values.items():
+                    setattr(obj, field, value)
+                obj.modified = now
+                objects_to_update.append(obj)
+            objects.append(obj)
+
+        with transaction.atomic():
+            VtexClientOrderItem.objects.bulk_create(
+                objects_to_create, batch_size=BULK_BATCH_SIZE
+            )
+            VtexClientOrderItem.objects.bulk_update(
+                objects_to_update,
+                [
+                    *VtexClientOrderItem.DEFAULTS,
+                    "item_number",
+                    "item_qty",
+                    "item_price_without_tax",
+                    "modified",
+                ],
+                batch_size=BULK_BATCH_SIZE,
+            )
         return objects
 
     class Meta:
@@ -157,27 +270,24 @@ class VtexClientOrderItem(OrderItem):
 class VtexClientOrder(Order):
     """Vtex client order model."""
 
-    def __init__(self, *args, **kwargs):
-        """Set vtex order default values."""
-        kwargs["order_type"] = "H"
-        kwargs["client_code"] = "CT0000344"
-        kwargs["file_type"] = "E-COMM"
-        kwargs["company_code"] = "120"
-        kwargs["currency"] = "COP"
-        kwargs["sell_type"] = "V010"
-        kwargs["sell_type_code"] = "222"
-        kwargs["payment_proof"] = ""
-        kwargs["seller_code"] = "V02011"
-        kwargs["route_text_code"] = ""
+    DEFAULTS = {
+        "order_type": "H",
+        "client_code": "CT0000344",
+        "file_type": "E-COMM",
+        "company_code": "120",
+        "currency": "COP",
+        "sell_type": "V010",
+        "sell_type_code": "222",
+        "payment_proof": "",
+        "seller_code": "V02011",
+        "route_text_code": "",
         # TODO warehouse_code is dynamic
-        kwargs["warehouse_code"] = "CM0000001"
-        super().__init__(*args, **kwargs)
+        "warehouse_code": "CM0000001",
+    }
 
     @staticmethod
-    def get_orders(
-        headers: dict = None, querystring: dict = None, page: int = 1
-    ) -> list:
-        """Get orders from vtex."""
+    def get_orders(headers: dict = None, querystring: dict = None) -> Iterator[dict]:
+        """Get orders from vtex, yielding each one as soon as it is fetched."""
         if headers is None:
             headers = {
                 "accept": "application/json",
@@ -189,43 +299,43 @@ class VtexClientOrder(Order):
             querystring = {
                 "f_creationDate": "creationDate:[2016-01-01T02:00:00.000Z TO 2021-01-01T01:59:59.999Z]",
             }
-        querystring["page"] = page
-        order_list_api_response = requests.request(
-            "GET",
-            settings.VTEX_ORDER_LIST_API_ENDPOINT,
-            headers=headers,
-            params=querystring,
-        ).json()
-
-        orders_list = [
-            requests.request(
-                "GET",
-                settings.VTEX_ORDER_API_ENDPOINT + order_summary["orderId"],
-                headers=headers,
-            ).json()
-            for order_summary in order_list_api_response["list"]
-        ]
 
-        current_page = order_list_api_response["paging"]["currentPage"]
-        total_pages = order_list_api_response["paging"]["pages"]
-        if current_page < total_pages:
-            next_page = current_page + 1
-            return orders_list + VtexClientOrder.get_orders(
-                headers, querystring, page=next_page
+        def get_orders_page(page: int) -> dict:
+            return cached_get(
+                settings.VTEX_ORDER_LIST_API_ENDPOINT,
+                headers=headers,
+                params={**querystring, "page": page},
             )
 
-        return orders_list
+        def get_order(order_id: str) -> dict:
+            return cached_get(settings.VTEX_ORDER_API_ENDPOINT + order_id, headers)
+
+        first_page = get_orders_page(1)
+        total_pages = first_page["paging"]["pages"]
+        order_ids = [order_summary["orderId"] for order_summary in first_page["list"]]
+        with ThreadPoolExecutor(max_workers=VTEX_API_MAX_WORKERS) as executor:
+            for page in executor.map(get_orders_page, range(2, total_pages + 1)):
+                order_ids.extend(
+                    order_summary["orderId"] for order_summary in page["list"]
+                )
+            # Keep at most VTEX_API_MAX_WORKERS order details in flight, so a
+            # slow or stopped consumer also holds back the fetching.
+            pending_orders = deque()
+            for order_id in order_ids:
+                if len(pending_orders) >= VTEX_API_MAX_WORKERS:
+                    yield pending_orders.popleft().result()
+                pending_orders.append(executor.submit(get_order, order_id))
+            while pending_orders:
+                yield pending_orders.popleft().result()
 
     @staticmethod
     def format_ws_address_data(order: dict) -> dict:
         """Get dict addresses data."""
         address_data = order["shippingData"]["selectedAddresses"][0]
         address_info = " ".join(
-            [
-                address_data[info]
-                for info in ["street", "number", "complement", "neighborhood"]
-                if address_data.get(info)
-            ]
+            info
+            for info in (address_data.get(field) for field in ADDRESS_INFO_FIELDS)
+            if info
         )
         return {
             "city": address_data.get("city"),
@@ -237,10 +347,11 @@ class VtexClientOrder(Order):
     @staticmethod
     def factory(orders_from_api: list):
         """Orders factory method."""
-        objects = []
+        orders = {}
         for order in orders_from_api:
             address = VtexClientOrder.format_ws_address_data(order)
-            defaults = {
+            orders[order["orderId"]] = {
+                **VtexClientOrder.DEFAULTS,
                 "order_created_at": VtexClientOrder.ws_strptime(order["creationDate"]),
                 "shipping_stimate_date": VtexClientOrder.ws_strptime(
                     order["shippingData"]["logisticsInfo"][0]["shippingEstimateDate"]
@@ -254,76 +365,121 @@ class VtexClientOrder(Order):
                 "shipping_address_reference": address["reference"],
                 "shipping_address_zip": address["postal_code"],
                 "order_number": order["orderId"],
-                "route_text_code": "",
-                "from_api": order,
             }
-            objects.append(
-                VtexClientOrder.objects.update_or_create(
-                    order_number=order["orderId"], defaults=defaults
-                )[0]
+        raw_data = {order["orderId"]: order for order in orders_from_api}
+        existing_orders = VtexClientOrder.objects.select_related("raw").in_bulk(
+            orders, field_name="order_number"
+        )
+
+        objects, objects_to_create, objects_to_update = [], [], []
+        now = timezone.now()
+        for order_number, defaults in orders.items():
+            obj = existing_orders.get(order_number)
+            if obj is None:
+                obj = VtexClientOrder(**defaults)
+                objects_to_create.append(obj)
+            else:
+                for field, value in defaults.items():
+                    setattr(obj, field, value)
+                obj.modified = now
+                objects_to_update.append(obj)
+            objects.append(obj)
+
+        with transaction.atomic():
+            VtexClientOrder.objects.bulk_create(
+                objects_to_create, batch_size=BULK_BATCH_SIZE
+            )
+            VtexClientOrder.objects.bulk_update(
+                objects_to_update,
+                [
+                    *VtexClientOrder.DEFAULTS,
+                    "order_created_at",
+                    "shipping_stimate_date",
+                    "buyer_fullname",
+                    "buyer_document",
+                    "buyer_phone",
+                    "buyer_email",
+                    "shipping_address",
+                    "shipping_address_city",
+                    "shipping_address_reference",
+                    "shipping_address_zip",
+                    "modified",
+                ],
+                batch_size=BULK_BATCH_SIZE,
+            )
+
+            raws_to_create, raws_to_update = [], []
+            for obj in objects_to_create:
+                obj.raw = OrderRaw(data=raw_data[obj.order_number])
+                raws_to_create.append(obj.raw)
+            for obj in objects_to_update:
+                if hasattr(obj, "raw"):
+                    obj.raw.data = raw_data[obj.order_number]
+                    obj.raw.modified = now
+                    raws_to_update.append(obj.raw)
+                else:
+                    obj.raw = OrderRaw(data=raw_data[obj.order_number])
+                    raws_to_create.append(obj.raw)
+            OrderRaw.objects.bulk_create(raws_to_create, batch_size=BULK_BATCH_SIZE)
+            OrderRaw.objects.bulk_update(
+                raws_to_update, ["data", "modified"], batch_size=BULK_BATCH_SIZE
             )
         return objects
 
     @staticmethod
-    def get_file_headers(order: Order) -> list:
-        """Get list of file headers."""
-        return [
-            f"{order.order_type}",  # Tipo
-            f"|{order.client_code}",  # Código del tercero
-            f"|{order.file_type}",  # Tipo de archivo
-            f"|{order.company_code}",  # Compañia
-            f"|{VtexClientOrder.erp_strftime(order.order_created_at)}",  # Fecha de la orden
-            f"|{VtexClientOrder.erp_strftime(order.shipping_stimate_date)}",
-            # Fecha planificada de entrega
-            f"|{order.currency}",  # Moneda
-            f"|{order.buyer_fullname}/{order.buyer_document}/{order.shipping_address_city}/{order.shipping_address}/{order.buyer_phone}/{order.shipping_address_reference}",
-            # Texto
-            "|1",  # 1
-            f"|{order.warehouse_code}",  # CodDirección de la cabecera
-            f"|{order.order_number}",  # No. pedido
-            f"|?,{order.buyer_document},?,{order.buyer_fullname},{order.sell_type},{order.shipping_address_zip}",
-            # Datos localización Colombia
-            f"|{order.sell_type_code},{order.payment_proof}",  # Tipo de venta + Ref A
-            f"|{order.seller_code}",  # Vendedor
-            f"|{order.route_text_code}",  # CodTextoRuta
-            f"|{order.buyer_email}",  # Correo electrónico
-        ]
+    def get_file_headers(order: Order) -> str:
+        """Get file headers content."""
+        return FILE_HEADERS_TEMPLATE.format_map(
+            {
+                "order": order,
+                "order_created_at": VtexClientOrder.erp_strftime(
+                    order.order_created_at
+                ),
+                "shipping_stimate_date": VtexClientOrder.erp_strftime(
+                    order.shipping_stimate_date
+                ),
+            }
+        )
 
     @staticmethod
-    def get_file_items(items: List[OrderItem]) -> list:
-        """Get list of file item."""
-        return [
-            "".join(
-                [
-                    f"{item.item_type}",
-                    f"|{item.item_number}",
-                    f"|{item.ean}",
-                    f"|{item.item_qty}",
-                    f"|{item.item_price_without_tax}",
-                    f"|{item.destination_address_code}|",
-                    f"|{item.qty}",
-                    f"|{item.tax_code}",
-                ]
-            )
+    def get_file_items(items: List[OrderItem]) -> str:
+        """Get file items content."""
+        return "\n".join(
+            f"{item.item_type}"
+            f"|{item.item_number}"
+            f"|{item.ean}"
+            f"|{item.item_qty}"
+            f"|{item.item_price_without_tax}"
+            f"|{item.destination_address_code}|"
+            f"|{item.qty}"
+            f"|{item.tax_code}"
             for item in items
-        ]
+        )
+
+    @staticmethod
+    def create_order_file(sftp_clients: Queue, file_path: str, content: bytes):
+        """Create an order file through the first idle sftp channel."""
+        sftp = sftp_clients.get()
+        try:
+            with sftp.file(file_path, "wb") as order_file:
+                order_file.write(content)
+        finally:
+            sftp_clients.put(sftp)
 
     @staticmethod
-    def create_order_files(sftp: paramiko.SFTPClient, orders: List[Order]):
-        """Create order files."""
-        for order in orders:
-            print(order, "create_order_files")
-            items = order.orderitem_set.all()
-            file_path = f"ag-pruebas/{order.order_number}.txt"
-            with sftp.file(file_path, "wt") as order_file:
-                print("file", order_file)
-                order_file.writelines(VtexClientOrder.get_file_headers(order))
-                order_file.write("\n")
-                order_file.writelines("\n".join(VtexClientOrder.get_file_items(items)))
+    def get_file_content(order: Order) -> bytes:
+        """Get order file content."""
+        headers = VtexClientOrder.get_file_headers(order)
+        items = VtexClientOrder.get_file_items(order.orderitem_set.all())
+        return f"{headers}\n{items}".encode("utf-8")
 
     @staticmethod
     def upload_to_sftp(orders: List[Order]):
         """Upload a order list through sftp."""
+        channels = min(SFTP_MAX_CHANNELS, len(orders))
+        if not channels:
+            return
+
         with paramiko.SSHClient() as ssh_client:
             ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
             ssh_client.connect(
@@ -333,8 +489,23 @@ class VtexClientOrder(Order):
                 password=settings.SFTP_PASSWORD,
             )
 
-            with ssh_client.open_sftp() as sftp:
-                VtexClientOrder.create_order_files(sftp, orders)
+            with ExitStack() as stack, ThreadPoolExecutor(channels) as executor:
+                sftp_clients = Queue()
+                for _channel in range(channels):
+                    sftp_clients.put(stack.enter_context(ssh_client.open_sftp()))
+                # Each file is submitted as soon as its content is built, so
+                # uploads run while the remaining files are being formatted.
+                uploads = [
+                    executor.submit(
+                        VtexClientOrder.create_order_file,
+                        sftp_clients,
+                        f"ag-pruebas/{order.order_number}.txt",
+                        VtexClientOrder.get_file_content(order),
+                    )
+                    for order in orders
+                ]
+                for upload in uploads:
+                    upload.result()
 
     class Meta:
         """Set model as proxy."""
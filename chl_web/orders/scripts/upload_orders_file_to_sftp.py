@@ -1,12 +1,37 @@
 """Scripts for upload order files to sftp."""
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from django.db.models import prefetch_related_objects
+
 from ..models import VtexClientOrder, VtexClientOrderItem, paramiko
 
+ORDERS_LIMIT = 3
+ORDERS_BATCH_SIZE = 50
 
 paramiko.util.log_to_file("paramiko.log")
 
-def run():
-    orders_from_api = VtexClientOrder.get_orders()
-    orders_from_db = VtexClientOrder.factory(orders_from_api[0:3])
-    VtexClientOrderItem.factory(orders_from_db)
-    VtexClientOrder.upload_to_sftp(orders_from_db)
 
+def run(*args):
+    """
+    Upload vtex orders as sftp files.
+
+    The number of orders to upload defaults to ``ORDERS_LIMIT`` and can be
+    changed with ``runscript upload_orders_file_to_sftp --script-args <limit>``.
+    """
+    limit = int(args[0]) if args else ORDERS_LIMIT
+    orders_from_api = islice(VtexClientOrder.get_orders(), limit)
+    batches = iter(lambda: list(islice(orders_from_api, ORDERS_BATCH_SIZE)), [])
+    # Batches are stored while vtex keeps fetching and the previous
+    # batch is uploaded in the background.
+    with ThreadPoolExecutor(max_workers=1) as uploader:
+        uploads = []
+        for batch in batches:
+            orders_from_db = VtexClientOrder.factory(batch)
+            VtexClientOrderItem.factory(orders_from_db)
+            prefetch_related_objects(orders_from_db, "orderitem_set")
+            uploads.append(
+                uploader.submit(VtexClientOrder.upload_to_sftp, orders_from_db)
+            )
+        for upload in uploads:
+            upload.result()
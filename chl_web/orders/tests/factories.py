@@ -0,0 +1,34 @@
+def vtex_order(order_id: str = "1061390511111-01", **client_profile) -> dict:
+    """Build an order payload shaped like the vtex order api response."""
+    return {
+        "orderId": order_id,
+        "creationDate": "2020-09-22T17:30:01.1234567+00:00",
+        "clientProfileData": {
+            "firstName": "Ana",
+            "lastName": "Pérez",
+            "document": "1020304050",
+            "phone": "+573001234567",
+            "email": "ana@example.com",
+            **client_profile,
+        },
+        "shippingData": {
+            "logisticsInfo": [
+                {"shippingEstimateDate": "2020-09-25T16:06:59.7347458+00:00"}
+            ],
+            "selectedAddresses": [
+                {
+                    "street": "Calle 10",
+                    "number": "20-30",
+                    "complement": None,
+                    "neighborhood": "Chapinero",
+                    "city": "Bogotá",
+                    "reference": None,
+                    "postalCode": "110231",
+                }
+            ],
+        },
+        "items": [
+            {"ean": "7701234567890", "quantity": 2, "price": 4990000},
+            {"ean": "7709876543210", "quantity": 1, "price": 1250050},
+        ],
+    }
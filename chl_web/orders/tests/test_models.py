@@ -0,0 +1,322 @@
+import re
+from datetime import datetime, timedelta
+from io import BytesIO
+from itertools import islice
+from queue import Queue
+from types import SimpleNamespace
+
+import pytest
+import requests
+from django.core.cache import cache
+from django.db.models import prefetch_related_objects
+
+from chl_web.orders import models
+from chl_web.orders.models import (
+    Order,
+    OrderItem,
+    OrderRaw,
+    VtexClientOrder,
+    VtexClientOrderItem,
+)
+from chl_web.orders.tests.factories import vtex_order
+
+pytestmark = pytest.mark.django_db
+
+
+def test_get_orders_filter_hours_range_defaults_to_last_hour():
+    before = datetime.utcnow()
+    hours_range = Order.get_orders_filter_hours_range()
+    after = datetime.utcnow()
+
+    match = re.fullmatch(r"creationDate:\[(\S+) TO (\S+)\]", hours_range)
+    assert match is not None
+    from_time, to_time = (
+        datetime.strptime(bound, "%Y-%m-%dT%H:%M:%S.%fZ") for bound in match.groups()
+    )
+    assert from_time < to_time
+    assert to_time - from_time == timedelta(hours=1)
+    assert before <= to_time <= after
+
+
+@pytest.fixture
+def vtex_api(monkeypatch) -> SimpleNamespace:
+    cache.clear()
+    vtex_api = SimpleNamespace(responses=[], requested=[])
+
+    def get(url: str, **kwargs) -> requests.Response:
+        vtex_api.requested.append(url)
+        return vtex_api.responses.pop(0)
+
+    monkeypatch.setattr(models.session, "get", get)
+    return vtex_api
+
+
+def vtex_response(status_code: int, content: bytes) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = content
+    return response
+
+
+def test_cached_get_reuses_cached_response(vtex_api):
+    vtex_api.responses.append(vtex_response(200, b'{"orderId": "1"}'))
+
+    first = models.cached_get("https://vtex.test/orders/1", {})
+    second = models.cached_get("https://vtex.test/orders/1", {})
+
+    assert first == second == {"orderId": "1"}
+    assert vtex_api.requested == ["https://vtex.test/orders/1"]
+
+
+def test_cached_get_raises_and_skips_cache_on_error(vtex_api):
+    vtex_api.responses.append(vtex_response(429, b"Too Many Requests"))
+    vtex_api.responses.append(vtex_response(200, b'{"orderId": "1"}'))
+
+    with pytest.raises(requests.HTTPError):
+        models.cached_get("https://vtex.test/orders/1", {})
+
+    assert models.cached_get("https://vtex.test/orders/1", {}) == {"orderId": "1"}
+    assert len(vtex_api.requested) == 2
+
+
+def test_vtex_client_order_get_orders_stops_fetching_with_consumer(monkeypatch):
+    order_ids = [f"{number}-01" for number in range(200)]
+    fetched = []
+
+    def cached_get(url: str, headers: dict, params: dict = None) -> dict:
+        if params is not None:
+            return {
+                "list": [{"orderId": order_id} for order_id in order_ids],
+                "paging": {"currentPage": 1, "pages": 1},
+            }
+        fetched.append(url)
+        return vtex_order(url.rsplit("/", 1)[-1])
+
+    monkeypatch.setattr(models, "cached_get", cached_get)
+    orders = VtexClientOrder.get_orders()
+
+    assert [order["orderId"] for order in islice(orders, 3)] == order_ids[:3]
+    orders.close()
+    assert len(fetched) <= 3 + models.VTEX_API_MAX_WORKERS
+
+
+def test_vtex_client_order_factory_creates_orders():
+    orders = VtexClientOrder.factory([vtex_order()])
+
+    order = Order.objects.get()
+    assert [obj.pk for obj in orders] == [order.pk]
+    assert order.order_number == "1061390511111-01"
+    assert order.buyer_fullname == "Ana Pérez"
+    assert order.shipping_address == "Calle 10 20-30 Chapinero"
+    assert order.order_type == VtexClientOrder.DEFAULTS["order_type"]
+    assert order.raw.data == vtex_order()
+
+
+def test_vtex_client_order_factory_updates_existing_orders():
+    first = VtexClientOrder.factory([vtex_order()])[0]
+    second = VtexClientOrder.factory([vtex_order(firstName="María")])[0]
+
+    assert second.pk == first.pk
+    assert Order.objects.count() == 1
+    assert OrderRaw.objects.count() == 1
+    order = Order.objects.get()
+    assert order.buyer_fullname == "María Pérez"
+    assert order.raw.data["clientProfileData"]["firstName"] == "María"
+
+
+def test_vtex_client_order_factory_deduplicates_orders_by_number():
+    orders = VtexClientOrder.factory([vtex_order(), vtex_order(firstName="María")])
+
+    assert len(orders) == 1
+    assert Order.objects.get().buyer_fullname == "María Pérez"
+
+
+def test_vtex_client_order_factory_creates_missing_raw():
+    VtexClientOrder.factory([vtex_order()])
+    OrderRaw.objects.all().delete()
+
+    VtexClientOrder.factory([vtex_order(firstName="María")])
+
+    assert Order.objects.get().raw.data["clientProfileData"]["firstName"] == "María"
+
+
+def test_vtex_client_order_item_factory_updates_items_in_place():
+    payload = vtex_order()
+    orders = VtexClientOrder.factory([payload])
+    first_items = VtexClientOrderItem.factory(orders)
+
+    payload["items"][0]["quantity"] = 5
+    orders = VtexClientOrder.factory([payload])
+    second_items = VtexClientOrderItem.factory(orders)
+
+    assert [item.pk for item in second_items] == [item.pk for item in first_items]
+    assert OrderItem.objects.count() == 2
+    item = OrderItem.objects.get(ean="7701234567890")
+    assert item.item_number == 1
+    assert item.item_qty == 5
+    assert item.item_price_without_tax == 49900
+    assert item.tax_code == VtexClientOrderItem.DEFAULTS["tax_code"]
+
+
+def test_vtex_client_order_item_factory_deduplicates_items_by_ean():
+    payload = vtex_order()
+    payload["items"].append({"ean": "7701234567890", "quantity": 3, "price": 4990000})
+    orders = VtexClientOrder.factory([payload])
+
+    items = VtexClientOrderItem.factory(orders)
+
+    assert len(items) == 2
+    assert OrderItem.objects.get(ean="7701234567890").item_qty == 3
+
+
+@pytest.mark.parametrize(
+    "creation_date, shipping_estimate_date, erp_dates",
+    [
+        (
+            "2020-09-22T17:30:01.1234567+00:00",
+            "2020-09-25T16:06:59.7347458+00:00",
+            "22092020|25092020",
+        ),
+        (
+            "2020-09-22T20:30:01+00:00",
+            "2020-09-25T23:59:59.9999999+00:00",
+            "22092020|25092020",
+        ),
+    ],
+)
+def test_vtex_client_order_get_file_content(
+    creation_date: str, shipping_estimate_date: str, erp_dates: str
+):
+    payload = vtex_order()
+    payload["creationDate"] = creation_date
+    payload["shippingData"]["logisticsInfo"][0][
+        "shippingEstimateDate"
+    ] = shipping_estimate_date
+    orders = VtexClientOrder.factory([payload])
+    VtexClientOrderItem.factory(orders)
+    prefetch_related_objects(orders, "orderitem_set")
+    order = orders[0]
+    order.route_text_code = None
+
+    assert VtexClientOrder.get_file_content(order) == (
+        f"H|CT0000344|E-COMM|120|{erp_dates}|COP"
+        "|Ana Pérez/1020304050/Bogotá/Calle 10 20-30 Chapinero/+573001234567/"
+        "|1|CM0000001|1061390511111-01|?,1020304050,?,Ana Pérez,V010,110231"
+        "|222,|V02011|None|ana@example.com\n"
+        "D|1|7701234567890|2|49900.0|||0|001\n"
+        "D|2|7709876543210|1|12500.0|||0|001"
+    ).encode("utf-8")
+
+
+class FakeSFTPFile(BytesIO):
+    def __init__(self, files: dict, path: str):
+        super().__init__()
+        self.files = files
+        self.path = path
+
+    def close(self):
+        self.files[self.path] = self.getvalue()
+        super().close()
+
+
+class FakeSFTPClient:
+    def __init__(self, files: dict):
+        self.files = files
+        self.closed = False
+
+    def file(self, path: str, mode: str) -> FakeSFTPFile:
+        assert mode == "wb"
+        return FakeSFTPFile(self.files, path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.closed = True
+
+
+class FakeSSHClient:
+    def __init__(self):
+        self.files = {}
+        self.sftp_clients = []
+        self.connect_kwargs = None
+
+    def set_missing_host_key_policy(self, policy):
+        pass
+
+    def connect(self, **kwargs):
+        self.connect_kwargs = kwargs
+
+    def open_sftp(self) -> FakeSFTPClient:
+        sftp_client = FakeSFTPClient(self.files)
+        self.sftp_clients.append(sftp_client)
+        return sftp_client
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+@pytest.fixture
+def ssh_clients(monkeypatch) -> list:
+    clients = []
+
+    def ssh_client():
+        clients.append(FakeSSHClient())
+        return clients[-1]
+
+    monkeypatch.setattr(models.paramiko, "SSHClient", ssh_client)
+    return clients
+
+
+def stored_orders(count: int) -> list:
+    orders = VtexClientOrder.factory(
+        [vtex_order(f"10613905{number:05d}-01") for number in range(count)]
+    )
+    VtexClientOrderItem.factory(orders)
+    prefetch_related_objects(orders, "orderitem_set")
+    return orders
+
+
+def test_vtex_client_order_upload_to_sftp_writes_one_file_per_order(ssh_clients):
+    orders = stored_orders(10)
+
+    VtexClientOrder.upload_to_sftp(orders)
+
+    [ssh_client] = ssh_clients
+    assert ssh_client.connect_kwargs["hostname"] == models.settings.SFTP_HOSTNAME
+    assert len(ssh_client.sftp_clients) == models.SFTP_MAX_CHANNELS
+    assert all(sftp_client.closed for sftp_client in ssh_client.sftp_clients)
+    assert ssh_client.files == {
+        f"ag-pruebas/{order.order_number}.txt": VtexClientOrder.get_file_content(order)
+        for order in orders
+    }
+
+
+def test_vtex_client_order_upload_to_sftp_opens_one_channel_per_order(ssh_clients):
+    VtexClientOrder.upload_to_sftp(stored_orders(2))
+
+    [ssh_client] = ssh_clients
+    assert len(ssh_client.sftp_clients) == 2
+    assert len(ssh_client.files) == 2
+
+
+def test_vtex_client_order_upload_to_sftp_skips_empty_order_list(ssh_clients):
+    VtexClientOrder.upload_to_sftp([])
+
+    assert ssh_clients == []
+
+
+def test_vtex_client_order_create_order_file_releases_channel_on_error():
+    class FailingSFTPClient(FakeSFTPClient):
+        def file(self, path: str, mode: str):
+            raise IOError("Permission denied")
+
+    sftp_clients = Queue()
+    sftp_clients.put(FailingSFTPClient({}))
+
+    with pytest.raises(IOError):
+        VtexClientOrder.create_order_file(sftp_clients, "ag-pruebas/1.txt", b"H")
+    assert sftp_clients.qsize() == 1
@@ -0,0 +1,69 @@
+import importlib
+import threading
+
+import pytest
+from django.conf import settings
+
+from chl_web.orders import models
+from chl_web.orders.models import Order, VtexClientOrder
+from chl_web.orders.tests.factories import vtex_order
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def script(monkeypatch):
+    # The script sends paramiko logs to a file when it is imported.
+    monkeypatch.setattr(models.paramiko.util, "log_to_file", lambda filename: None)
+    return importlib.import_module("chl_web.orders.scripts.upload_orders_file_to_sftp")
+
+
+@pytest.fixture
+def uploads(monkeypatch) -> list:
+    order_ids = [f"10613905{number:05d}-01" for number in range(120)]
+
+    def cached_get(url: str, headers: dict, params: dict = None) -> dict:
+        if url == settings.VTEX_ORDER_LIST_API_ENDPOINT:
+            return {
+                "list": [{"orderId": order_id} for order_id in order_ids],
+                "paging": {"currentPage": 1, "pages": 1},
+            }
+        return vtex_order(url.rsplit("/", 1)[-1])
+
+    uploads = []
+
+    def upload_to_sftp(orders: list):
+        uploads.append(
+            {
+                "order_numbers": [order.order_number for order in orders],
+                "items_prefetched": all(
+                    "orderitem_set" in order._prefetched_objects_cache
+                    for order in orders
+                ),
+                "in_background": threading.current_thread()
+                is not threading.main_thread(),
+            }
+        )
+
+    monkeypatch.setattr(models, "cached_get", cached_get)
+    monkeypatch.setattr(VtexClientOrder, "upload_to_sftp", staticmethod(upload_to_sftp))
+    return uploads
+
+
+def test_run_uploads_default_limit(script, uploads):
+    script.run()
+
+    [upload] = uploads
+    assert len(upload["order_numbers"]) == script.ORDERS_LIMIT
+    assert upload["items_prefetched"]
+    assert Order.objects.count() == script.ORDERS_LIMIT
+
+
+def test_run_uploads_orders_in_batches(script, uploads):
+    script.run("120")
+
+    assert [len(upload["order_numbers"]) for upload in uploads] == [50, 50, 20]
+    assert all(upload["items_prefetched"] for upload in uploads)
+    assert all(upload["in_background"] for upload in uploads)
+    assert Order.objects.count() == 120
+    assert len({n for upload in uploads for n in upload["order_numbers"]}) == 120